@@ -27,6 +27,8 @@ General options:
   --influx_ssh_port <ifport>      SSH InfluxDB port [default: 22]
   --influx_ssh_user <ifuser>      SSH InfluxDB user
   --influx_ssh_password <ifpass>  SSH InfluxDB password
+  --influx_ssh_control_path <path>  ControlPath de un ControlMaster de OpenSSH ya abierto,
+                                  si esta activo se usa en vez de conectar con paramiko
 
 See measure_capacity_influxdb.py <command> --help for more information on a specific command.
 """
@@ -40,10 +42,15 @@ except ImportError:
 
 from influxdb import InfluxDBClient
 from datetime import datetime
-import math
-import re
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
 import paramiko
 import select
+import subprocess
+import csv
+import time
 import random
 import string
 
@@ -56,6 +63,28 @@ logger = logging.getLogger(__name__)
 
 __version__ = '0.1'
 RETURN_CODE_ERROR = 1
+# Segundos que se reutilizan los tamaños de los shards y el SHOW SHARDS
+CACHE_TTL = 60
+# Solo se quitan los kex DH con SHA-1. paramiko ya prefiere ECDH, asi que con un sshd
+# moderno la negociacion no cambia; curve25519 (paramiko >= 2.7) y DH con SHA-2
+# siguen disponibles para servers que no ofrecen ECDH nistp
+SSH_DISABLED_ALGORITHMS = {
+    'kex': [
+        'diffie-hellman-group1-sha1',
+        'diffie-hellman-group14-sha1',
+        'diffie-hellman-group-exchange-sha1',
+    ],
+}
+# Comandos ssh simultaneos sobre una conexion, por debajo del MaxSessions (10) de sshd
+SSH_MAX_SESSIONS = 8
+# Suma el tamaño de los ficheros de cada shard (<var_dir>/<db>/<rp>/<id>) de una database
+# El exit status de find se pasa a awk en una linea "@rc", para que no lo oculte la tuberia
+# -ignore_readdir_race: compactaciones y retencion borran ficheros mientras find recorre el arbol
+SHARDS_SIZE_CMD = "{ sudo -n find %s -ignore_readdir_race -mindepth 3 -type f " \
+        "-printf '%%s\\t%%P\\n'; printf '@rc\\t%%s\\n' $?; } | " \
+        "awk -F'\\t' '$1 == \"@rc\" {rc = $2; next} " \
+        "{split($2, p, \"/\")} p[2] ~ /^[0-9]+$/ {s[p[2]] += $1} " \
+        "END {for (k in s) print s[k] \"\\t\" k; exit rc}'"
 
 
 ################################################################################
@@ -64,6 +93,11 @@ class Client(object):
     InfluxDB client to make testing
     """
 
+    # Conexiones ssh ya autenticadas, compartidas entre instancias por (host, port, user)
+    _ssh_pool = {}
+    # Resultados cacheados: clave -> (ttl_bucket, valor)
+    _cache = {}
+
     def __init__(self, args):
         logger.debug("Inicializar cliente InfluxDB.\n" \
                 "Host: %s:%s/%s\n" \
@@ -81,6 +115,10 @@ class Client(object):
                 args['--influx_user'], args['--influx_password'],
                 args['--influx_db'], timeout = args['--influx_timeout'])
 
+        self.influx_host = args['--influx_host']
+        self.influx_port = args['--influx_port']
+        self.influx_user = args['--influx_user']
+        self.influx_pass = args['--influx_password']
         self.influx_db = args['--influx_db']
 
         # SSH params
@@ -88,34 +126,65 @@ class Client(object):
             self.ssh_host = args['--influx_ssh_host']
         else:
             self.ssh_host = args['--influx_host']
+        self.ssh_port = args['--influx_ssh_port']
         self.ssh_user = args['--influx_ssh_user']
         self.ssh_pass = args['--influx_ssh_password']
+        self.ssh_control_path = args['--influx_ssh_control_path']
+        # Se comprueba una sola vez si el ControlMaster esta activo
+        self._control_master = None
 
         # Dict para almacenar los tamaños de los shards obtenidos por ssh
         self.shards_size_list = {}
 
-    def _parse_du(self, line):
+    def _parse_du(self, data):
         """
-        Parseamos una linea tipo:
-            23248   /opt/influxdb/data/ddbb/default/1939
-        El id sera el ultimo elemento tras la /
-        El primer elemento seran los bytes
-        El numero de espacios en blanco pueda que sea variable
-        Retornamos id del shard y su tamaño
+        Parseamos un bloque de lineas tipo (bytes, tabulador, id del shard):
+            23248\t1939
+        El bloque llega sin decodificar, tal cual sale del canal ssh
+        Retornamos un dict con el tamaño de cada shard por su id
         """
-        regexp = re.compile(r"([0-9]+)\s+.*/([0-9]+)")
-        r = re.match(regexp, line)
-        return int(r.group(2)), int(r.group(1))
+        return {int(shard_id): int(size_bytes)
+                for size_bytes, _, shard_id in (line.partition(b'\t') for line in data.splitlines())
+                if size_bytes}
 
-    def _get_all_shards_size(self, var_dir):
+    def _cached(self, key, func, *args):
         """
-        Conecta por ssh y ejecuta un comando para obtener el tamaño de todos los shards
+        Devuelve func(*args), reutilizando el valor si se calculo dentro del mismo
+        intervalo de CACHE_TTL segundos
+        Si func falla se invalida la entrada
+        """
+        ttl_bucket = int(time.time() // CACHE_TTL)
+        cached = Client._cache.get(key)
+        if cached and cached[0] == ttl_bucket:
+            logger.debug("Usando valor cacheado para %s", key)
+            return cached[1]
+
+        try:
+            value = func(*args)
+        except Exception:
+            Client._cache.pop(key, None)
+            raise
+
+        Client._cache[key] = (ttl_bucket, value)
+        return value
+
+    def _get_ssh(self):
         """
+        Devuelve la conexion ssh del pool para (host, port, user)
+        Solo se conecta si no existe o si el transport ya no esta activo
+        """
+        ssh = Client._ssh_pool.setdefault((self.ssh_host, self.ssh_port, self.ssh_user),
+                paramiko.SSHClient())
+        transport = ssh.get_transport()
+        if transport is not None and transport.is_active():
+            logger.debug("Reutilizando conexion ssh")
+            return ssh
 
         try:
-            ssh = paramiko.SSHClient()
             ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-            ssh.connect(self.ssh_host, username=self.ssh_user, password=self.ssh_pass)
+            ssh.connect(self.ssh_host, port=int(self.ssh_port), username=self.ssh_user,
+                    password=self.ssh_pass, disabled_algorithms=SSH_DISABLED_ALGORITHMS)
+            ssh.get_transport().set_keepalive(30)
             logger.debug("Conectado por ssh")
         except paramiko.AuthenticationException:
             logger.error("Authentication failed when connecting ssh")
@@ -124,35 +193,230 @@ class Client(object):
             logger.error("Excepcion conectando por ssh: %s", ex)
             sys.exit(1)
 
-        cmd = "sudo find %s -maxdepth 3 -mindepth 3 -exec du -b {} \;" % var_dir
-        logger.debug("Enviando comando: %s", cmd)
-        (stdin, stdout, stderr) = ssh.exec_command(cmd, get_pty=True)
-
-        for line in stdout.readlines():
-            logger.debug(line)
-            shard_id, size_bytes = self._parse_du(line)
-            self.shards_size_list[shard_id] = size_bytes
+        return ssh
 
-        logger.debug("shards_size_list: %s", self.shards_size_list)
+    def _exec(self, ssh, cmd, stdin=None):
+        """
+        Lanza un comando en un canal nuevo de la conexion ssh, sin esperar a que termine
+        Si se indica, stdin se envia al comando y se cierra su entrada
+        No se pide pty, la salida llega tal cual, sin CRLF ni disciplina de terminal.
+        Por eso sudo se usa con -n: sin tty no puede pedir password, asi termina con error
+        en vez de quedarse esperando (hace falta NOPASSWD para find en sudoers)
+        """
+        logger.debug("Enviando comando: %s", cmd)
+        channel = ssh.get_transport().open_session()
+        channel.exec_command(cmd)
+        if stdin is not None:
+            channel.sendall(stdin)
+            channel.shutdown_write()
+        return channel
+
+    def _drain(self, jobs):
+        """
+        Vacia a la vez stdout y stderr de varios canales ssh ya lanzados,
+        sin bloquearse en ninguno de ellos
+        jobs es una lista de (channel, parse)
+        select despierta con datos tanto en stdout como en stderr de cualquier canal
+        Segun llegan datos se llama al parse de su canal con el bloque de lineas completas de stdout
+        Retorna (exit status, stderr) de cada canal, en el mismo orden
+        """
+        parsers = dict(jobs)
+        buffers = dict((channel, b'') for channel, _ in jobs)
+        errors = dict((channel, []) for channel, _ in jobs)
+        status = {}
+        pending = [channel for channel, _ in jobs]
+
+        while pending:
+            select.select(pending, [], [], 1.0)
+            for channel in list(pending):
+                # Los datos llegan antes que el EOF, si ya lo teniamos no queda nada por llegar
+                eof = channel.eof_received
+                while channel.recv_stderr_ready():
+                    errors[channel].append(channel.recv_stderr(65536))
+                if channel.recv_ready():
+                    data = buffers[channel] + channel.recv(65536)
+                    lines, _, buffers[channel] = data.rpartition(b'\n')
+                    if lines:
+                        parsers[channel](lines)
+                elif eof:
+                    pending.remove(channel)
+                    status[channel] = channel.recv_exit_status()
+                    # Ultima linea sin \n final
+                    if buffers[channel]:
+                        parsers[channel](buffers[channel])
+
+        return [(status[channel], b''.join(errors[channel]).decode('utf-8', 'replace'))
+                for channel, _ in jobs]
+
+    def _ssh_cmd(self, *args):
+        """
+        Linea de comandos de OpenSSH para usar el socket del ControlMaster
+        BatchMode: si el master muere tras el check, ssh abriria una conexion nueva
+        y podria pedir password; asi falla en el acto
+        """
+        cmd = ["ssh", "-S", self.ssh_control_path, "-o", "BatchMode=yes", "-p", self.ssh_port]
+        if self.ssh_user:
+            cmd += ["-l", self.ssh_user]
+        return cmd + list(args)
 
-        for line in stderr.readlines():
+    def _control_master_alive(self):
+        """
+        Comprueba si hay un ControlMaster de OpenSSH activo en --influx_ssh_control_path
+        """
+        if self._control_master is None:
+            self._control_master = False
+            if self.ssh_control_path:
+                try:
+                    check = subprocess.Popen(self._ssh_cmd("-O", "check", self.ssh_host),
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                    check.communicate()
+                    self._control_master = check.returncode == 0
+                except OSError as ex:
+                    # Sin cliente ssh en el PATH se usa paramiko
+                    logger.debug("No se puede ejecutar ssh: %s", ex)
+                logger.debug("ControlMaster %s activo: %s",
+                        self.ssh_control_path, self._control_master)
+        return self._control_master
+
+    def _run(self, jobs):
+        """
+        Ejecuta los comandos en el host por ssh, en paralelo (hasta SSH_MAX_SESSIONS)
+        jobs es una lista de (cmd, parse, stdin), parse recibe bloques de lineas completas de stdout
+        y stdin (o None) se envia al comando, para no poner secretos en la linea de comandos
+        Si hay un ControlMaster activo se reutiliza su conexion ya autenticada,
+        si no se usa la conexion de paramiko del pool
+        Retorna (exit status, stderr) de cada comando, en el mismo orden
+        """
+        results = []
+        if self._control_master_alive():
+            for i in range(0, len(jobs), SSH_MAX_SESSIONS):
+                procs = []
+                for cmd, parse, stdin in jobs[i:i + SSH_MAX_SESSIONS]:
+                    logger.debug("Enviando comando por ControlMaster: %s", cmd)
+                    procs.append((subprocess.Popen(self._ssh_cmd(self.ssh_host, cmd),
+                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE),
+                            parse, stdin))
+                for proc, parse, stdin in procs:
+                    (stdout, stderr) = proc.communicate(stdin)
+                    parse(stdout)
+                    results.append((proc.returncode, stderr.decode('utf-8', 'replace')))
+            return results
+
+        ssh = self._get_ssh()
+        for i in range(0, len(jobs), SSH_MAX_SESSIONS):
+            results.extend(self._drain([(self._exec(ssh, cmd, stdin), parse)
+                    for cmd, parse, stdin in jobs[i:i + SSH_MAX_SESSIONS]]))
+        return results
+
+    def _check(self, cmd, status, stderr):
+        """
+        Vuelca al log de errores la salida de error de un comando ssh
+        Retorna True si el comando ha terminado bien
+        """
+        for line in stderr.splitlines():
             logger.error("SSH COMMAND stderr: %s", line)
+        if status != 0:
+            logger.error("SSH COMMAND exit status %s: %s", status, cmd)
+        return status == 0
+
+    def _influx_job(self, query, parse):
+        """
+        Job de _run para ejecutar una query con el cliente influx del host ssh, con salida csv
+        La password no va en la linea de comandos (se veria con ps y en el log),
+        se envia por stdin y el cliente la lee de INFLUX_PASSWORD
+        """
+        cmd = "influx -host %s -port %s -format csv" % (
+                quote(self.influx_host), quote(self.influx_port))
+        if self.influx_user:
+            cmd += " -username %s" % quote(self.influx_user)
+        cmd += " -execute %s" % quote(query)
+
+        if not self.influx_pass:
+            return (cmd, parse, None)
+        # IFS vacio para que read no recorte espacios al principio o al final de la password
+        return ("IFS= read -r INFLUX_PASSWORD; export INFLUX_PASSWORD; " + cmd, parse,
+                (self.influx_pass + "\n").encode('utf-8'))
+
+    def _get_all_shards_size(self, var_dir, show_shards=False):
+        """
+        Conecta por ssh y ejecuta un comando para obtener el tamaño de todos los shards
+        Se lanza un comando por database, en paralelo sobre la misma conexion ssh
+        Si show_shards, en la misma tanda de comandos se ejecuta SHOW SHARDS con
+        el cliente influx del host
+        Retorna un dict con el tamaño de cada shard por su id y las series de
+        SHOW SHARDS (None si no se han podido obtener por ssh)
+        """
+        shards_size_list = {}
+        databases = []
+        show_shards_csv = []
+
+        # Listamos los directorios de cada database a la vez que se ejecuta SHOW SHARDS
+        list_cmd = "sudo -n find %s -mindepth 1 -maxdepth 1 -type d -printf '%%f\\n'"
+        jobs = [(list_cmd % quote(var_dir), lambda data: databases.extend(data.splitlines()), None)]
+        if show_shards:
+            # SHOW DATABASES para tener tambien las databases sin shards, como en la API HTTP
+            jobs.append(self._influx_job("SHOW DATABASES; SHOW SHARDS", show_shards_csv.append))
+        results = self._run(jobs)
+        # Si falla el find (p.e. sudo sin NOPASSWD) no podemos dar un tamaño
+        if not self._check(jobs[0][0], *results[0]):
+            sys.exit(RETURN_CODE_ERROR)
 
+        series = None
+        if show_shards:
+            (status, stderr) = results[1]
+            if status == 0:
+                self._check(jobs[1][0], status, stderr)
+                series = _parse_show_shards_csv(b'\n'.join(show_shards_csv))
+            else:
+                # Sin cliente influx en el host (o si falla) se usa la API HTTP
+                logger.debug("Cliente influx no disponible por ssh (exit status %s), "
+                        "se usara HTTP: %s", status, stderr)
+        logger.debug("Directorios de databases: %s", databases)
+
+        # Si esta definida la db, solo recorremos su directorio
+        if self.influx_db:
+            databases = [db for db in databases if db.decode('utf-8') == self.influx_db]
+
+        # Un solo find por database recorre su arbol y awk suma los bytes de los ficheros
+        # por directorio de shard (p.e. ddbb/default/1939), en vez de lanzar un du por cada shard
+        jobs = [(SHARDS_SIZE_CMD % quote("%s/%s" % (var_dir, db.decode('utf-8'))),
+                lambda data: shards_size_list.update(self._parse_du(data)), None)
+                for db in databases]
+        # Un fallo aqui (ficheros que desaparecen durante el recorrido) solo se registra,
+        # si sudo no funcionara ya habria fallado el listado de directorios
+        for (cmd, _, _), (status, stderr) in zip(jobs, self._run(jobs)):
+            self._check(cmd, status, stderr)
+
+        logger.debug("shards_size_list: %s", shards_size_list)
+        return shards_size_list, series
 
     def _get_shard_size(self, shard_id):
         """
         De la lista ya bajada, obtenemos el que nos solicitan
         El shard id es unico para todo influx
+        Si el shard no existe en el FS su tamaño es 0
         """
-        return self.shards_size_list.get(shard_id)
+        return self.shards_size_list.get(shard_id, 0)
+
+    def _iso_date(self, yyyymmdd):
+        """
+        Convierte una fecha YYYYMMDD al formato de las fechas de SHOW SHARDS:
+            20170501 -> 2017-05-01T00:00:00Z
+        Lanza ValueError si no son 8 digitos o el mes/dia no existe
+        """
+        if len(yyyymmdd) != 8 or not yyyymmdd.isdigit():
+            raise ValueError("Fecha '%s' no tiene el formato YYYYMMDD" % yyyymmdd)
+        # datetime valida el mes y el dia
+        return datetime(int(yyyymmdd[:4]), int(yyyymmdd[4:6]), int(yyyymmdd[6:8])).isoformat() + "Z"
 
     def _size(self, size_bytes):
         if (size_bytes == 0):
             return '0B'
         size_name = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
-        i = int(math.floor(math.log(size_bytes, 1024)))
-        p = math.pow(1024, i)
-        s = round(size_bytes/p, 2)
+        # Cada unidad son 10 bits, el indice sale de bit_length con aritmetica entera
+        i = min((size_bytes.bit_length() - 1) // 10, len(size_name) - 1)
+        p = 1 << (i * 10)
+        s = round(float(size_bytes) / p, 2)
         return '%s %s' % (s, size_name[i])
 
     ############################################################################
@@ -170,62 +434,130 @@ Options:
   --full                                Mostrar los datos de todas las DBs
         """
 
-        from_date = datetime.strptime(args['--from'],"%Y%m%d")
-        to_date = datetime.strptime(args['--to'],"%Y%m%d")
+        # Las fechas de SHOW SHARDS son ISO-8601 en UTC, comparando las cadenas
+        # directamente evitamos parsear dos fechas por cada shard
+        from_s = self._iso_date(args['--from'])
+        to_s = self._iso_date(args['--to'])
         var_dir = args['--dir']
         logger.info("Calculando tamaño de shards desde %s hasta %s para database %s (dir: %s)"
-                    , from_date, to_date, self.influx_db, var_dir)
+                    , from_s, to_s, self.influx_db, var_dir)
 
         logger.info("Conectando por ssh para obtener tamaño de todos los shards")
-        self._get_all_shards_size(var_dir)
-
-        logger.debug("Ejecutando query SHOW SHARDS para obtener la info de fecha de cada uno")
-        shards = self.client.query("SHOW SHARDS")
+        # Si el host ssh es el propio nodo de InfluxDB, SHOW SHARDS se ejecuta con el
+        # cliente influx en la misma conexion ssh, sin otra conexion HTTP
+        show_shards = self.ssh_host == self.influx_host
+        du_key = ("du", self.ssh_host, self.ssh_port, self.ssh_user,
+                var_dir, self.influx_db, show_shards)
+        self.shards_size_list, series = self._cached(du_key,
+                self._get_all_shards_size, var_dir, show_shards)
+
+        if series is None:
+            logger.debug("Ejecutando query SHOW SHARDS para obtener la info de fecha de cada uno")
+            shards = self._cached(
+                    ("SHOW SHARDS", self.influx_host, self.influx_port, self.influx_user),
+                    self.client.query, "SHOW SHARDS")
+            series = shards.raw.get("series", [])
         total_size = 0
+        # Lineas de salida, se escriben todas juntas al final
+        out = []
 
-        logger.info("Analizando cada grupo de shards para calcula su tamaño total")
-        for group in shards:
-            # Ignoramos arrays vacios
-            try:
-                database = group[0].get("database")
-            except Exception:
-                pass
+        # Recorremos directamente las series en crudo, sin crear un dict por cada shard
+        # Cada serie de SHOW SHARDS se llama como su database
 
-            # Si esta definida la db, solo analizamos los shards de esa db
-            if self.influx_db and database != self.influx_db:
-                continue
+        # Si esta definida la db, solo analizamos los shards de esa db
+        # (InfluxQL no soporta "SHOW SHARDS ON <db>")
+        # Paramos de buscar en cuanto encontramos su serie
+        if self.influx_db:
+            series = [next((serie for serie in series if serie["name"] == self.influx_db),
+                    {"name": self.influx_db})]
+
+        logger.info("Analizando cada grupo de shards para calcula su tamaño total")
+        for serie in series:
+            database = serie["name"]
+            # Las databases sin shards no tienen values
+            values = serie.get("values", [])
 
             # Iniciamos el array de la database
             shard_size = 0
 
-            for s in group:
-                shard_start_time = datetime.strptime(s.get("start_time"),"%Y-%m-%dT%H:%M:%SZ")
-                shard_end_time = datetime.strptime(s.get("end_time"),"%Y-%m-%dT%H:%M:%SZ")
+            if values:
+                columns = serie["columns"]
+                id_idx = columns.index("id")
+                start_idx = columns.index("start_time")
+                end_idx = columns.index("end_time")
 
+            for row in values:
                 # Si el shard es mas antiguo que la fecha que queremos, lo descartamos
                 # Si es mas nuevo que lo que queremos lo descartamos tambien
-                if shard_start_time < from_date:
+                # El filtro tiene que ser aqui: SHOW SHARDS no admite WHERE y la
+                # medida _internal.shard no tiene el start_time/end_time del shard
+                if row[start_idx] < from_s:
                     continue
-                if shard_end_time > to_date:
+                if row[end_idx] > to_s:
                     continue
 
-                try:
-                    shard_size += self._get_shard_size(s.get("id"))
-                except Exception as ex:
-                    logger.debug("Shard no existente en el FS %s", s.get("id"))
+                shard_size += self._get_shard_size(row[id_idx])
 
             if args['--full'] or self.influx_db:
-                print("%s: %s" % (self._size(shard_size), database))
+                out.append("%s: %s" % (self._size(shard_size), database))
             total_size += shard_size
 
         if not self.influx_db:
-            print("TOTAL: %s" % (self._size(total_size)))
+            out.append("TOTAL: %s" % (self._size(total_size)))
+
+        sys.stdout.write("\n".join(out) + "\n")
 
 
     ############################################################################
 
 ################################################################################
 #
+def _parse_show_shards_csv(data):
+    """
+    Convierte la salida csv de "SHOW DATABASES; SHOW SHARDS" del cliente influx:
+        name,name
+        databases,telegraf
+        name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners
+        telegraf,3,telegraf,autogen,3,2017-05-01T00:00:00Z,2017-05-08T00:00:00Z,...
+    en la misma lista de series que devuelve la API HTTP en crudo: una por database,
+    en el orden de SHOW DATABASES y sin values si la database no tiene shards
+    """
+    databases = []
+    shards = {}
+    columns = None
+    is_shards = False
+    for row in csv.reader(data.decode('utf-8').splitlines()):
+        if not row:
+            continue
+        # La cabecera se puede repetir por cada serie
+        if row[0] == "name":
+            is_shards = "id" in row
+            if is_shards:
+                columns = row[1:]
+                id_idx = columns.index("id")
+            continue
+        if not is_shards:
+            databases.append(row[1])
+            continue
+        if row[0] not in shards:
+            shards[row[0]] = []
+            if row[0] not in databases:
+                databases.append(row[0])
+        values = row[1:]
+        values[id_idx] = int(values[id_idx])
+        shards[row[0]].append(values)
+
+    series = []
+    for database in databases:
+        serie = {"name": database}
+        if columns is not None:
+            serie["columns"] = columns
+        if database in shards:
+            serie["values"] = shards[database]
+        series.append(serie)
+    return series
+
+
 def _execute_cmd(method, args):
     """
     Execute command
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+pytest.importorskip("docopt")
+pytest.importorskip("influxdb")
+pytest.importorskip("paramiko")
+
+from measure_shards_size import Client, _parse_show_shards_csv
+
+
+@pytest.fixture
+def client():
+    # Los metodos probados no usan el estado del cliente, no hace falta conectar
+    return Client.__new__(Client)
+
+
+# Salida de: influx -format csv -execute 'SHOW DATABASES; SHOW SHARDS'
+# La cabecera de SHOW SHARDS se repite por cada serie y "vacia" no tiene shards
+SHOW_SHARDS_CSV = b"""name,name
+databases,_internal
+databases,vacia
+databases,telegraf
+name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners
+_internal,1,_internal,monitor,1,2017-05-01T00:00:00Z,2017-05-02T00:00:00Z,2017-05-09T00:00:00Z,
+name,id,database,retention_policy,shard_group,start_time,end_time,expiry_time,owners
+telegraf,3,telegraf,autogen,3,2017-05-01T00:00:00Z,2017-05-08T00:00:00Z,2017-05-08T00:00:00Z,
+telegraf,4,telegraf,autogen,4,2017-05-08T00:00:00Z,2017-05-15T00:00:00Z,2017-05-15T00:00:00Z,
+"""
+
+
+def test_parse_show_shards_csv():
+    series = _parse_show_shards_csv(SHOW_SHARDS_CSV)
+
+    assert [serie["name"] for serie in series] == ["_internal", "vacia", "telegraf"]
+    assert "values" not in series[1]
+
+    telegraf = series[2]
+    id_idx = telegraf["columns"].index("id")
+    start_idx = telegraf["columns"].index("start_time")
+    assert [row[id_idx] for row in telegraf["values"]] == [3, 4]
+    assert telegraf["values"][1][start_idx] == "2017-05-08T00:00:00Z"
+
+
+def test_size_unit_boundaries(client):
+    units = ("B", "KB", "MB", "GB", "TB", "PB", "EB", "ZB", "YB")
+    assert client._size(0) == "0B"
+    for n, unit in enumerate(units):
+        assert client._size(1024 ** n) == "1.0 %s" % unit
+    assert client._size(1023) == "1023.0 B"
+    assert client._size(1024 ** 5 - 1) == "1024.0 TB"
+
+
+def test_size_caps_at_yb(client):
+    assert client._size(1024 ** 9) == "1024.0 YB"
+
+
+def test_iso_date(client):
+    assert client._iso_date("20170501") == "2017-05-01T00:00:00Z"
+
+
+@pytest.mark.parametrize("fecha", ["20171340", "2017131"])
+def test_iso_date_rejects_invalid(client, fecha):
+    with pytest.raises(ValueError):
+        client._iso_date(fecha)